@@ -121,7 +121,14 @@ func handleList(w http.ResponseWriter, r *http.Request) {
 		Files: files,
 	}
 
+	// Version of exactly this listing, so clients can record what they indexed
+	paths := make([]string, len(files))
+	for i, f := range files {
+		paths[i] = f.Path
+	}
+
 	w.Header().Set("Content-Type", "application/json")
+	w.Header().Set("X-Version", hashPaths(paths))
 	json.NewEncoder(w).Encode(response)
 }
 
@@ -198,6 +205,11 @@ func computeVersion() string {
 		})
 	}
 
+	return hashPaths(paths)
+}
+
+// hashPaths returns the version string for a set of file paths.
+func hashPaths(paths []string) string {
 	sort.Strings(paths)
 
 	h := sha256.New()
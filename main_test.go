@@ -151,6 +151,9 @@ func TestHandleList(t *testing.T) {
 	if len(resp.Files) != 3 {
 		t.Errorf("expected 3 files, got %d", len(resp.Files))
 	}
+	if got, want := w.Header().Get("X-Version"), computeVersion(); got != want {
+		t.Errorf("expected X-Version %s, got %s", want, got)
+	}
 }
 
 func TestHandleFilter(t *testing.T) {
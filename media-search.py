@@ -7,18 +7,43 @@ Usage:
     ./media-search.py index --force   # Force sync even if versions match
     ./media-search.py search "query"  # Search the index
     ./media-search.py hosts           # List configured hosts
+
+    ./media-search.py --server localhost:8000 search "query"  # Use a ChromaDB server
 """
 
 import argparse
-import json
+import asyncio
+import functools
+import hashlib
 import sys
+import threading
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import chromadb
 import httpx
+import ijson
+import numpy as np
+import orjson
+from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
 
 CONFIG_FILE = Path(__file__).parent / "media-hosts.json"
 DB_PATH = Path(__file__).parent / ".media-index"
+HOST_COLLECTION_PREFIX = "media_"  # Each host's files live in their own collection
+BATCH_SIZE = 250  # Records per ChromaDB add/delete call
+SYNC_WORKERS = 2  # Hosts synced into ChromaDB at once; more just contend on its locks
+QUERY_CACHE_FILE = DB_PATH / "query_cache.json"
+QUERY_CACHE_SIZE = 256  # Most recent search queries to keep embeddings for
+
+# ChromaDB's default model (ONNX all-MiniLM-L6-v2), shared by indexing and search.
+# One instance keeps its ONNX session and tokenizer loaded for the whole process
+# (DefaultEmbeddingFunction builds a fresh one per call). It runs on every
+# onnxruntime provider available, so uses the GPU when one is.
+EMBEDDING_FUNCTION = ONNXMiniLM_L6_V2()
+# Its model download and session setup happen lazily without locking,
+# so sync worker threads take this lock around the first load
+MODEL_LOCK = threading.Lock()
 
 
 def load_hosts():
@@ -26,78 +51,218 @@ def load_hosts():
         print(f"No config file found at {CONFIG_FILE}")
         print("Create one with: {\"hosts\": [{\"name\": \"my-box\", \"url\": \"http://host:port\"}]}")
         sys.exit(1)
-    return json.loads(CONFIG_FILE.read_text())["hosts"]
+    return orjson.loads(CONFIG_FILE.read_bytes())["hosts"]
+
 
+def server_address(value: str) -> tuple[str, int]:
+    """Parse a --server value of host:port (port defaults to 8000)."""
+    host, _, port = value.partition(":")
+    if not host or (port and not port.isdigit()):
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {value!r}")
+    return host, int(port or 8000)
 
-def get_client():
+
+@functools.cache
+def get_client(server: tuple[str, int] | None = None):
+    """Open the local index, or a standalone ChromaDB server as (host, port)."""
+    if server:
+        host, port = server
+        return chromadb.HttpClient(host=host, port=port)
     return chromadb.PersistentClient(path=str(DB_PATH))
 
 
-def get_collection(client=None):
-    if client is None:
-        client = get_client()
-    return client.get_or_create_collection("media")
+@functools.cache
+def get_host_collection(server: tuple[str, int] | None, host_name: str):
+    """
+    Get the collection holding one host's files.
+    Named by a digest of the host name, as collection names are restricted.
+    """
+    digest = hashlib.blake2b(host_name.encode(), digest_size=8).hexdigest()
+    return get_client(server).get_or_create_collection(
+        f"{HOST_COLLECTION_PREFIX}{digest}", metadata={"host": host_name}
+    )
+
+
+@functools.cache
+def get_versions_collection(server: tuple[str, int] | None = None):
+    """Get the (empty) collection whose metadata holds the stored host versions."""
+    return get_client(server).get_or_create_collection("versions")
+
+
+@functools.cache
+def load_embedding_model():
+    """Run the embedding model once so it is downloaded and loaded."""
+    EMBEDDING_FUNCTION(["warm up"])
+
+
+def file_id(host_name: str, path: str) -> str:
+    """Fixed-length document ID for a file on a host (128-bit BLAKE2 digest)."""
+    return hashlib.blake2b(f"{host_name}\0{path}".encode(), digest_size=16).hexdigest()
 
 
 def get_stored_versions(collection) -> dict[str, str]:
     """Get stored versions from collection metadata."""
     meta = collection.metadata or {}
     versions_json = meta.get("versions", "{}")
-    return json.loads(versions_json)
+    return orjson.loads(versions_json)
 
 
 def store_versions(collection, versions: dict[str, str]):
     """Store versions in collection metadata (serialized as JSON string)."""
-    collection.modify(metadata={"versions": json.dumps(versions)})
+    collection.modify(metadata={"versions": orjson.dumps(versions).decode()})
 
 
-def fetch_host_version(host: dict) -> str | None:
+async def fetch_host_version(client: httpx.AsyncClient, host: dict) -> str | None:
     """Fetch version from a host's health endpoint."""
     try:
-        resp = httpx.get(f"{host['url']}/health", timeout=5)
+        resp = await client.get(f"{host['url']}/health", timeout=5)
         resp.raise_for_status()
-        return resp.json().get("version")
+        return orjson.loads(resp.content).get("version")
     except Exception as e:
-        print(f"  Warning: Could not fetch version from {host['name']}: {e}")
+        print(f"Warning: Could not fetch version from {host['name']}: {e}")
         return None
 
 
-def sync_host(collection, host: dict, files: list[dict]) -> tuple[int, int]:
+async def fetch_host_files(
+    client: httpx.AsyncClient, host: dict, stored_version: str | None
+) -> tuple[str | None, list[dict] | None]:
+    """
+    Fetch the full file list from a host's list endpoint.
+    The response is parsed as it streams in, so the raw body is never held in memory.
+    Returns (listing_version, files), with files None if the listing matches stored_version.
+    """
+    files = []
+    parsed = ijson.sendable_list()
+    parser = ijson.items_coro(parsed, "files.item")
+    async with client.stream("GET", f"{host['url']}/list") as resp:
+        resp.raise_for_status()
+        # Servers report the version of the listing they send, which may
+        # differ from /health if files changed in between
+        listing_version = resp.headers.get("X-Version")
+        if listing_version is not None and listing_version == stored_version:
+            return listing_version, None
+        async for chunk in resp.aiter_bytes():
+            parser.send(chunk)
+            files.extend({"name": f["name"], "path": f["path"]} for f in parsed)
+            del parsed[:]
+    parser.close()
+    files.extend({"name": f["name"], "path": f["path"]} for f in parsed)
+    return listing_version, files
+
+
+async def process_host(
+    client: httpx.AsyncClient, host: dict, stored_versions: dict[str, str]
+) -> tuple[str | None, list[dict] | None]:
+    """
+    Check a host's version and fetch its files if they have changed.
+    Returns (current_version, files_or_None).
+    """
+    stored_version = stored_versions.get(host["name"])
+    current_version = await fetch_host_version(client, host)
+    if current_version is None or current_version == stored_version:
+        return current_version, None
+
+    listing_version, files = await fetch_host_files(client, host, stored_version)
+    return listing_version or current_version, files
+
+
+def sync_host(collection, host: dict, files: Iterable[dict]) -> tuple[int, int]:
     """
     Sync files from a host using smart diffing.
     Returns (added_count, removed_count).
     """
-    # Build set of IDs from server
-    server_ids = {f"{host['name']}:{f['path']}" for f in files}
-
-    # Get existing IDs for this host from ChromaDB
-    existing = collection.get(
-        where={"host": host["name"]},
-        include=[]  # We only need IDs
-    )
+    # Get existing IDs; the collection only holds this host's files,
+    # so no metadata filter is needed
+    existing = collection.get(include=[])  # We only need IDs
     existing_ids = set(existing["ids"])
 
-    # Compute diff
-    to_add_ids = server_ids - existing_ids
-    to_remove_ids = existing_ids - server_ids
+    # Single pass over the server's files: note every ID seen and
+    # collect the ones we don't have yet
+    seen = set()
+    add_ids, add_docs, add_metas = [], [], []
+    for f in files:
+        fid = file_id(host["name"], f["path"])
+        if fid in seen:
+            continue  # Overlapping --dir flags can list a path twice
+        seen.add(fid)
+        if fid not in existing_ids:
+            add_ids.append(fid)
+            add_docs.append(f["name"])
+            add_metas.append({"path": f["path"], "host": host["name"]})
+
+    # Anything we have that the server no longer lists was deleted
+    to_remove = existing_ids - seen
 
     # Remove deleted files
-    if to_remove_ids:
-        collection.delete(ids=list(to_remove_ids))
-
-    # Add new files
-    if to_add_ids:
-        # Build file lookup for new files
-        files_by_id = {f"{host['name']}:{f['path']}": f for f in files}
-        new_files = [files_by_id[id] for id in to_add_ids]
-
+    remove_ids = list(to_remove)
+    for i in range(0, len(remove_ids), BATCH_SIZE):
+        collection.delete(ids=remove_ids[i:i + BATCH_SIZE])
+
+    if add_ids:
+        with MODEL_LOCK:
+            load_embedding_model()
+
+    # Add new files, embedding each distinct name in the batch only once
+    # (media libraries repeat names like "poster.jpg" across many folders)
+    for i in range(0, len(add_ids), BATCH_SIZE):
+        docs = add_docs[i:i + BATCH_SIZE]
+        names = list(dict.fromkeys(docs))
+        vectors = dict(zip(names, EMBEDDING_FUNCTION(names)))
         collection.add(
-            ids=[f"{host['name']}:{f['path']}" for f in new_files],
-            documents=[f["name"] for f in new_files],
-            metadatas=[{"path": f["path"], "host": host["name"]} for f in new_files],
+            ids=add_ids[i:i + BATCH_SIZE],
+            documents=docs,
+            metadatas=add_metas[i:i + BATCH_SIZE],
+            embeddings=[vectors[doc] for doc in docs],
         )
 
-    return len(to_add_ids), len(to_remove_ids)
+    return len(add_ids), len(to_remove)
+
+
+def embed_query(query: str) -> list[float]:
+    """
+    Embed a search query, reusing the embedding from an earlier run if we have one.
+    Uses the same embedding function as indexing.
+    """
+    try:
+        cache = orjson.loads(QUERY_CACHE_FILE.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        cache = {}
+
+    if query in cache:
+        # Move a reused query to the end so it is evicted last
+        embedding = cache.pop(query)
+    else:
+        embedding = EMBEDDING_FUNCTION([query])[0].tolist()
+
+    # Drop the least recently used queries once the cache is full
+    cache[query] = embedding
+    cache = dict(list(cache.items())[-QUERY_CACHE_SIZE:])
+    QUERY_CACHE_FILE.parent.mkdir(exist_ok=True)
+    QUERY_CACHE_FILE.write_bytes(orjson.dumps(cache))
+    return embedding
+
+
+async def index_host(
+    client: httpx.AsyncClient,
+    host: dict,
+    stored_versions: dict[str, str],
+    server: tuple[str, int] | None,
+    executor: ThreadPoolExecutor,
+) -> tuple[str | None, tuple[int, int] | None]:
+    """
+    Fetch a host's files if they have changed and sync them on a worker thread,
+    so its ChromaDB writes overlap with other hosts' requests.
+    Returns (current_version, (added, removed) or None if no sync was needed).
+    """
+    current_version, files = await process_host(client, host, stored_versions)
+    if files is None:
+        return current_version, None
+
+    print(f"Syncing {len(files)} files from {host['name']}...")
+    collection = get_host_collection(server, host["name"])
+    loop = asyncio.get_running_loop()
+    counts = await loop.run_in_executor(executor, sync_host, collection, host, files)
+    return current_version, counts
 
 
 def cmd_hosts(args):
@@ -106,16 +271,34 @@ def cmd_hosts(args):
         print(f"{h['name']}: {h['url']}")
 
 
-def cmd_index(args):
+async def cmd_index_async(args):
     hosts = load_hosts()
-    client = get_client()
-    collection = get_collection(client)
+    client = get_client(args.server)
+    versions_collection = get_versions_collection(args.server)
+
+    # Indexes from before per-host collections kept every host in "media"
+    if any(c.name == "media" for c in client.list_collections()):
+        print("Removing old single-collection index, all hosts will be re-synced")
+        client.delete_collection("media")
 
     if getattr(args, "force", False):
         print("Force mode: ignoring versions, syncing all hosts")
         stored_versions = {}
     else:
-        stored_versions = get_stored_versions(collection)
+        stored_versions = get_stored_versions(versions_collection)
+
+    # Query every host concurrently over one shared connection pool,
+    # syncing each one as soon as its files arrive
+    limits = httpx.Limits(max_connections=64)
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        async with httpx.AsyncClient(timeout=30, limits=limits) as http:
+            results = await asyncio.gather(
+                *[
+                    index_host(http, host, stored_versions, args.server, executor)
+                    for host in hosts
+                ],
+                return_exceptions=True,
+            )
 
     new_versions = {}
     total_added = 0
@@ -123,49 +306,38 @@ def cmd_index(args):
     hosts_updated = 0
     hosts_skipped = 0
 
-    for host in hosts:
-        print(f"Checking {host['name']}...")
+    for host, result in zip(hosts, results):
+        if isinstance(result, Exception):
+            print(f"{host['name']}: Error: {result}")
+            continue
 
-        # Fetch current version
-        current_version = fetch_host_version(host)
+        current_version, counts = result
         if current_version is None:
-            print(f"  Skipping (could not connect)")
+            print(f"{host['name']}: Skipped (could not connect)")
             # Keep old version if we had one
             if host["name"] in stored_versions:
                 new_versions[host["name"]] = stored_versions[host["name"]]
             continue
 
-        stored_version = stored_versions.get(host["name"])
-
-        # Check if update needed
-        if current_version == stored_version:
-            print(f"  No changes (version: {current_version[:20]}...)")
+        # Nothing was synced if the version matched
+        if counts is None:
+            print(f"{host['name']}: No changes (version: {current_version[:20]}...)")
             new_versions[host["name"]] = current_version
             hosts_skipped += 1
             continue
 
-        # Fetch full file list
-        print(f"  Changes detected, fetching files...")
-        try:
-            resp = httpx.get(f"{host['url']}/list", timeout=30)
-            resp.raise_for_status()
-            data = resp.json()
-            files = [{"name": f["name"], "path": f["path"]} for f in data["files"]]
-        except Exception as e:
-            print(f"  Error fetching files: {e}")
-            continue
-
-        # Sync using diff
-        added, removed = sync_host(collection, host, files)
-        print(f"  Synced: +{added} -{removed} files")
+        added, removed = counts
+        print(f"{host['name']}: Synced +{added} -{removed} files")
 
         new_versions[host["name"]] = current_version
         total_added += added
         total_removed += removed
         hosts_updated += 1
 
-    # Store updated versions
-    store_versions(collection, new_versions)
+    # Store updated versions once every host is done, skipping the
+    # metadata write on runs where nothing changed
+    if new_versions != get_stored_versions(versions_collection):
+        store_versions(versions_collection, new_versions)
 
     # Summary
     print()
@@ -173,32 +345,56 @@ def cmd_index(args):
     print(f"Total: +{total_added} added, -{total_removed} removed")
 
 
+def cmd_index(args):
+    asyncio.run(cmd_index_async(args))
+
+
 def cmd_search(args):
-    collection = get_collection()
+    client = get_client(args.server)
+
+    host_collections = [
+        collection for collection in client.list_collections()
+        if collection.name.startswith(HOST_COLLECTION_PREFIX)
+    ]
+    # Check before embedding, so an empty index never loads the model
+    if not host_collections:
+        print("Index is empty. Run 'index' first.")
+        return
+
+    # Search every host's collection, then rank their results together
+    query_embeddings = [embed_query(args.query)]
+    distances, documents, metadatas = [], [], []
+    for collection in host_collections:
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=args.limit,
+        )
+        distances.extend(results["distances"][0])
+        documents.extend(results["documents"][0])
+        metadatas.extend(results["metadatas"][0])
 
-    if collection.count() == 0:
+    # Any stored file is a match, so no results means every host is empty
+    if not distances:
         print("Index is empty. Run 'index' first.")
         return
 
-    results = collection.query(
-        query_texts=[args.query],
-        n_results=args.limit,
-    )
+    dists = np.asarray(distances)
+    top = np.argsort(dists, kind="stable")[:args.limit]
+    scores = 1.0 - dists[top] * 0.5  # Convert distance to similarity
 
-    for i, (doc, meta, dist) in enumerate(zip(
-        results["documents"][0],
-        results["metadatas"][0],
-        results["distances"][0],
-    )):
-        score = 1 - (dist / 2)  # Convert distance to similarity
-        print(f"[{meta['host']}] {doc}")
-        print(f"  {meta['path']}")
+    for i, score in zip(top.tolist(), scores.tolist()):
+        print(f"[{metadatas[i]['host']}] {documents[i]}")
+        print(f"  {metadatas[i]['path']}")
         print(f"  similarity: {score:.2f}")
         print()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Media search CLI")
+    parser.add_argument(
+        "--server", metavar="HOST:PORT", type=server_address,
+        help="Use a standalone ChromaDB server instead of the local index"
+    )
     subs = parser.add_subparsers(dest="command", required=True)
 
     subs.add_parser("hosts", help="List configured hosts")